@@ -9,14 +9,33 @@ other formats may be added in the future.
 
 import argparse
 
+from codecs import decode as codecs_decode
+from codecs import getencoder as codecs_getencoder
+from codecs import register_error as codecs_register_error
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from functools import lru_cache as functools_lru_cache
+from hashlib import blake2b as hashlib_blake2b
+from os import fstat as os_fstat
 from os import makedirs as os_makedirs
 from os import path as os_path
 from os import remove as os_remove
-from re import search as re_search
 from re import sub as re_sub
-from textwrap import wrap
-from unidecode import unidecode
+from shutil import copyfileobj as shutil_copyfileobj
+from sys import stdout as sys_stdout
+
+try:
+    from os import sendfile as os_sendfile
+except ImportError:  # not available on every platform
+    os_sendfile = None
+
+try:
+    import numpy
+
+    from numba import njit as numba_njit
+except ImportError:  # optional fast path; the pure-Python scan still works
+    numba_njit = None
+from unidecode import unidecode_expect_nonascii
 
 class Action(Enum):
     RETRO = 'retroencode'
@@ -28,6 +47,14 @@ ID3_DATA_FLAG_SIZE = 2
 
 ID3_DELIMITER = b"\x00"
 
+# not sure why I'm writing this after the frames, but a buffer seems like a
+# good idea
+ID3_TRAILER = ID3_DELIMITER * 32
+
+# maps valid tag name bytes (A-Z, 0-9) to \x01 and everything else to \x00,
+# so a 4-byte name is valid iff its translation sums to 4
+_TAG_NAME_OK = bytes(1 if 0x30 <= i <= 0x39 or 0x41 <= i <= 0x5A else 0 for i in range(256))
+
 ENCODING_ISO       = "ISO-8859-1"
 ENCODING_UNICODE   = "UTF-16"
 ENCODING_SHIFT_JIS = "Shift-JIS"
@@ -45,20 +72,90 @@ LOGO = """
                                     (ZITROG)
 """
 
+ACCEPTED_CORRECTION_LIMIT = 4096
+
 accepted_corrections = {}
 
-def print_log_lines(tab_depth_or_line_one, *definite_lines):
-    tab_content = "    "
+def _correction_key(data):
+    # short digests keep the cache keys small and comparisons cheap no matter
+    # how long the tag value is
+    return hashlib_blake2b(data.encode(ENCODING_UNICODE), digest_size=8).digest()
+
+def _remember_correction(correction_key, correction):
+    if len(accepted_corrections) >= ACCEPTED_CORRECTION_LIMIT:
+        accepted_corrections.pop(next(iter(accepted_corrections)))  # drop the oldest entry
+
+    accepted_corrections[correction_key] = correction
+
+_SJIS_OK = {}
+
+def _is_sjis(codepoint):
+    # per-codepoint encodability survives at module scope, so an album's worth
+    # of repeated artist/album values only ever probes each codepoint once
+    encodable = _SJIS_OK.get(codepoint)
+
+    if encodable is None:
+        try:
+            chr(codepoint).encode(ENCODING_SHIFT_JIS)
+            encodable = True
+        except UnicodeEncodeError:
+            encodable = False
+
+        _SJIS_OK[codepoint] = encodable
 
-    tab_depth_provided = type(tab_depth_or_line_one) == int
+    return encodable
+
+_SJIS_CODEPOINT_TABLE = None
+
+def _build_sjis_codepoint_table():
+    # probe the whole BMP in a single C-level encode; the registered handler
+    # records every codepoint the codec rejects (astral-plane codepoints never
+    # encode to Shift-JIS, so they stay invalid)
+    failed_codepoints = []
+
+    def record_failure(error):
+        failed_codepoints.extend(ord(char) for char in error.object[error.start:error.end])
+
+        return ("", error.end)
+
+    codecs_register_error("zitrog_table_probe", record_failure)
+    "".join(
+        chr(codepoint) for codepoint in range(0x10000) if not 0xD800 <= codepoint <= 0xDFFF
+    ).encode(ENCODING_SHIFT_JIS, errors="zitrog_table_probe")
+
+    table = numpy.zeros(0x110000, dtype=numpy.bool_)
+    table[:0x10000] = True
+    table[0xD800:0xE000] = False
+    table[failed_codepoints] = False
+
+    return table
+
+if numba_njit is not None:
+    @numba_njit(cache=True)
+    def _scan_sjis_errors(codepoints, table):
+        error_positions = numpy.empty(codepoints.shape[0], dtype=numpy.int64)
+        error_count = 0
+
+        for index in range(codepoints.shape[0]):
+            if not table[codepoints[index]]:
+                error_positions[error_count] = index
+                error_count += 1
+
+        return error_positions[:error_count]
+
+def print_log_lines(tab_depth_or_line_one, *definite_lines):
+    # isinstance instead of a type comparison, with bool excluded since it
+    # would otherwise read as a tab depth
+    tab_depth_provided = isinstance(tab_depth_or_line_one, int) and not isinstance(tab_depth_or_line_one, bool)
     tab_depth = tab_depth_or_line_one if tab_depth_provided else 0
+    tab_prefix = "    " * tab_depth
     lines = [
         *([] if tab_depth_provided or tab_depth_or_line_one is None else [tab_depth_or_line_one]),
         *definite_lines,
     ]
 
-    for line in lines:
-        print(f"{tab_content * tab_depth}{line}")
+    # one write call for the whole block instead of one print per line
+    sys_stdout.write("".join(f"{tab_prefix}{line}\n" for line in lines))
 
 def yes_no(prompt):
     while True:
@@ -69,47 +166,54 @@ def yes_no(prompt):
         elif decision == 'n':
             return False
 
-def padded_hex(input_int):
-    hex_str = hex(input_int)[2:].upper()
-
-    return f"0x{(len(hex_str) % 2) * '0'}{hex_str}"
+# one codec-registry lookup per process instead of one per encode call
+_SJIS_ENCODE = codecs_getencoder(ENCODING_SHIFT_JIS)
 
 def encode_data(data):
-    return ID3_DELIMITER + data.encode(ENCODING_SHIFT_JIS) + ID3_DELIMITER
+    return ID3_DELIMITER + _SJIS_ENCODE(data)[0] + ID3_DELIMITER
 
 def validate_data_encode(data):
-    try:
-        encode_data(data)
-        return True
-    except:
-        return False
+    return all(_is_sjis(ord(char)) for char in data)
 
 def identify_encode_error_positions(data):
-    error_positions = []
+    if numba_njit is not None:
+        global _SJIS_CODEPOINT_TABLE
 
-    for char_index,char in enumerate(data):
-        try:
-            char.encode(ENCODING_SHIFT_JIS)
-        except UnicodeEncodeError:
-            error_positions.append(char_index)
-        except:
-            print_log_lines(
-                "===== FATAL ENCODING ERROR =====",
-                f"RAW FRAME DATA: {data_raw}",
-                f"DECODED FRAME DATA (from {'utf-16' if data_is_unicode else 'iso'}): {alt_data_decoded}",
-                f"REFERENCE ENCODE (utf-8): {alt_data_decoded.encode()}",
-            )
+        if _SJIS_CODEPOINT_TABLE is None:  # built once, amortized over the batch
+            _SJIS_CODEPOINT_TABLE = _build_sjis_codepoint_table()
 
-            raise initial_encoding_error
+        codepoints = numpy.frombuffer(data.encode("utf-32-le"), dtype=numpy.uint32)
 
-    return error_positions
+        return _scan_sjis_errors(codepoints, _SJIS_CODEPOINT_TABLE).tolist()
+
+    return [char_index for char_index,char in enumerate(data) if not _is_sjis(ord(char))]
+
+_UNIDECODE_CACHE = {}
 
 def suggest_data_changes(data, error_positions):
-    return "".join(
-        char if char_index not in error_positions
-        else decoded_char if (decoded_char:=unidecode(char)) != char else "_"
-        for char_index,char in enumerate(data)
-    )
+    # build a codepoint -> replacement table for just the failing characters,
+    # then let str.translate rewrite the string in a single C-level pass;
+    # replacements are cached process-wide since tag values repeat heavily
+    table = {}
+
+    for position in set(error_positions):
+        codepoint = ord(data[position])
+        replacement = _UNIDECODE_CACHE.get(codepoint)
+
+        if replacement is None:
+            # error positions are never ASCII, so skip unidecode's ASCII check
+            decoded_char = unidecode_expect_nonascii(chr(codepoint))
+            replacement = _UNIDECODE_CACHE[codepoint] = decoded_char if decoded_char != chr(codepoint) else "_"
+
+        table[codepoint] = replacement
+
+    return data.translate(table)
+
+@functools_lru_cache(maxsize=4096)
+def _suggest_correction(data):
+    error_positions = identify_encode_error_positions(data)
+
+    return tuple(error_positions), suggest_data_changes(data, error_positions)
 
 def read_id3(input_path, preserved_tags=DEFAULT_PRESERVED_TAGS, automatic_correction=False, verbose=False):
     print_log_lines(
@@ -128,60 +232,69 @@ def read_id3(input_path, preserved_tags=DEFAULT_PRESERVED_TAGS, automatic_correc
         id3_identifier = id3_header[:3].decode(ENCODING_ISO)
         # id3_flags = id3_header[3:6]
         id3_size_encoded = id3_header[6:10]
-        id3_size = int(
-            "".join(
-                "{:08b}".format(byte)[1:] for byte in id3_size_encoded
-            ),
-            2
+        id3_size = (  # synchsafe: 7 value bits per byte
+            (id3_size_encoded[0] << 21)
+            | (id3_size_encoded[1] << 14)
+            | (id3_size_encoded[2] << 7)
+            | id3_size_encoded[3]
         )
 
         print_log_lines(
             id3_header,
-            f"REPORTED SIZE: {padded_hex(id3_size)}",
+            f"REPORTED SIZE: 0x{id3_size:08X}",
             # id3_identifier,
             "",
             "ID3 FRAMES:",
         )
 
         if id3_identifier != "ID3":
-            raise "Invalid ID3 identifier"
+            raise ValueError("Invalid ID3 identifier")
 
         id3_definition["header"] = id3_header[:6]
         id3_definition["content_offset"] = len(id3_header) + id3_size
 
-        while True:
-            frame_offset = input_file.tell()
-            frame_header = input_file.read(8)
+        # the whole tag block is small (rarely more than a few KB), so read it
+        # in one shot and parse frames against a cursor rather than issuing
+        # several small read()/tell() calls per frame
+        # the memoryview makes frame data slices zero-copy; only the small
+        # header/flag slices get materialized as bytes
+        frame_buffer = memoryview(input_file.read(id3_size))
+        cursor = 0
 
-            tag_name = frame_header[:4].decode(ENCODING_ISO)
+        while True:
+            frame_offset = len(id3_header) + cursor
+            frame_header = bytes(frame_buffer[cursor:cursor + 8])
 
-            if not bool(re_search(r"^[A-Z0-9]{4}$", tag_name)):  # invalid tag name check
-                print_log_lines(1, f"INVALID NEXT HEADER @ {padded_hex(frame_offset)}: {frame_header}")
+            if sum(frame_header[:4].translate(_TAG_NAME_OK)) != 4:  # invalid tag name check
+                print_log_lines(1, f"INVALID NEXT HEADER @ 0x{frame_offset:08X}: {frame_header}")
 
                 return id3_definition
 
+            tag_name = frame_header[:4].decode(ENCODING_ISO)
+
             data_length = int.from_bytes(frame_header[4:8], "big")
-            data_flags  = input_file.read(ID3_DATA_FLAG_SIZE)
-            data_raw    = input_file.read(data_length)
+            data_flags  = bytes(frame_buffer[cursor + 8:cursor + 8 + ID3_DATA_FLAG_SIZE])
+            data_raw    = frame_buffer[cursor + 10:cursor + 10 + data_length]
+            cursor += 10 + data_length  # 10 = frame header + data flags
 
             data_is_unicode = data_raw[:1] == b"\x01"
 
             if tag_name not in preserved_tags:
-                print_log_lines(1, f"Skipped tag @ {padded_hex(frame_offset)} with header {frame_header}")
+                print_log_lines(1, f"Skipped tag @ 0x{frame_offset:08X} with header {frame_header}")
                 continue
 
             try:
                 if data_is_unicode:
-                    data_decoded = data_raw[1:-2].decode(ENCODING_UNICODE)
+                    data_decoded = codecs_decode(data_raw[1:-2], ENCODING_UNICODE)
                 else:
-                    data_decoded = data_raw[1:-1].decode(ENCODING_ISO)
+                    data_decoded = codecs_decode(data_raw[1:-1], ENCODING_ISO)
             except UnicodeDecodeError:
                 print_log_lines(
                     "",
                     f"===== FATAL DECODING ERROR =====",
                     f"RAW FRAME HEADER: {frame_header}",
                     f"RAW FRAME DATA FLAGS: {data_flags}",
-                    f"RAW FRAME DATA: {data_raw}",
+                    f"RAW FRAME DATA: {bytes(data_raw)}",
                     "",
                 )
 
@@ -189,27 +302,28 @@ def read_id3(input_path, preserved_tags=DEFAULT_PRESERVED_TAGS, automatic_correc
 
             print_log_lines(
                 1,
-                f"{tag_name} [len:{padded_hex(data_length)}:{data_length}; "
-                f"flag:{padded_hex(int.from_bytes(data_flags, 'big'))}] "
-                f"{f'=v= {data_raw} ' if verbose else ''}"
+                f"{tag_name} [len:0x{data_length:08X}:{data_length}; "
+                f"flag:0x{int.from_bytes(data_flags, 'big'):04X}] "
+                f"{f'=v= {bytes(data_raw)} ' if verbose else ''}"
                 f"=~= {data_decoded[0:255] if data_decoded is not None else None}",
             )
 
             if not data_is_unicode:
-                data_encoded = data_raw
+                data_encoded = bytes(data_raw)
+            elif data_decoded.isascii():
+                # ASCII is a subset of Shift-JIS, so the (very common) plain
+                # ASCII tag skips the whole probe/suggest pipeline
+                data_encoded = ID3_DELIMITER + data_decoded.encode("ascii") + ID3_DELIMITER
             else:
-                try:
-                    alt_data_decoded = accepted_corrections[data_decoded]
-                except:
-                    alt_data_decoded = data_decoded
+                correction_key = _correction_key(data_decoded)
+                alt_data_decoded = accepted_corrections.get(correction_key, data_decoded)
 
                 data_encoded = None
                 while data_encoded is None:
                     if validate_data_encode(alt_data_decoded):
                         data_encoded = encode_data(alt_data_decoded)
                     else:
-                        error_positions = identify_encode_error_positions(alt_data_decoded)
-                        suggested_data_decoded = suggest_data_changes(alt_data_decoded, error_positions)
+                        error_positions,suggested_data_decoded = _suggest_correction(alt_data_decoded)
 
                         print_log_lines(
                             "",
@@ -230,15 +344,16 @@ def read_id3(input_path, preserved_tags=DEFAULT_PRESERVED_TAGS, automatic_correc
 
                         if manual_correction == "":
                             data_encoded = encode_data(suggested_data_decoded)
-                            accepted_corrections[data_decoded] = suggested_data_decoded
+                            _remember_correction(correction_key, suggested_data_decoded)
                         elif validate_data_encode(manual_correction):
                             data_encoded = encode_data(manual_correction)
-                            accepted_corrections[data_decoded] = manual_correction
+                            _remember_correction(correction_key, manual_correction)
                         else:
                             alt_data_decoded = manual_correction
 
             id3_definition["frames"].append({
                 "tag": tag_name,
+                "tag_bytes": frame_header[:4],  # saves re-encoding the name on write
                 "data_flags": data_flags,
                 "data": data_encoded,
                 "data_was_converted": data_is_unicode,  # if data was unicode, it got converted
@@ -273,33 +388,59 @@ def write_id3(input_path, output_dir_path, id3_definition, auto_overwrite=False,
     except OSError:
         pass
 
-    assembled_frames = b""
-    for frame_index,frame in enumerate(id3_definition["frames"]):
-        assembled_frames += frame["tag"].encode(ENCODING_ISO)
-        assembled_frames += len(frame["data"]).to_bytes(4, "big")
-        assembled_frames += frame["data_flags"]
-        assembled_frames += frame["data"]
-
-    assembled_frames += ID3_DELIMITER * 32  # not sure why I'm doing this, but a buffer seems like a good idea
-
-    with open(output_path, "wb") as output_file:
+    with open(output_path, "wb", buffering=1 << 20) as output_file:
+        # stream frames straight to the buffered output behind a placeholder
+        # size, then patch the real synchsafe size into the header once the
+        # total is known -- nothing gets assembled in memory first
         output_file.write(id3_definition["header"])
-        output_file.write(
-            int(
-                "".join(
-                    f"0{byte}" for byte in wrap("{:028b}".format(len(assembled_frames)), 7)
-                ),
-                2,
-            ).to_bytes(4, "big")
-        )
-        output_file.write(assembled_frames)
+        output_file.write(b"\x00\x00\x00\x00")  # synchsafe size placeholder
+
+        frames_length = 0
+        for frame in id3_definition["frames"]:
+            frames_length += output_file.write(frame["tag_bytes"])
+            frames_length += output_file.write(len(frame["data"]).to_bytes(4, "big"))
+            frames_length += output_file.write(frame["data_flags"])
+            frames_length += output_file.write(frame["data"])
+
+        frames_length += output_file.write(ID3_TRAILER)
+
+        output_file.seek(len(id3_definition["header"]))
+        output_file.write(bytes((
+            (frames_length >> 21) & 0x7F,
+            (frames_length >> 14) & 0x7F,
+            (frames_length >> 7) & 0x7F,
+            frames_length & 0x7F,
+        )))
+        output_file.seek(0, 2)
 
         with open(input_path, "rb") as input_file:
-            input_file.seek(id3_definition["content_offset"])
-            output_file.write(input_file.read())
+            content_offset = id3_definition["content_offset"]
+            file_size = os_fstat(input_file.fileno()).st_size
+
+            if os_sendfile is not None:
+                # let the kernel shuttle the MP3 body between the two
+                # descriptors with no user-space round trip
+                output_file.flush()
+
+                while content_offset < file_size:
+                    content_offset += os_sendfile(
+                        output_file.fileno(), input_file.fileno(), content_offset, file_size - content_offset,
+                    )
+            else:
+                input_file.seek(content_offset)
+                shutil_copyfileobj(input_file, output_file, length=1 << 20)
 
     return
 
+def process_file(task):
+    # top-level (and therefore picklable) worker for the process pool; each
+    # worker keeps its own module-level codec and correction caches, which
+    # warm up across the files it handles
+    input_path,output_dir_path,preserved_tags,automatic_correction,auto_overwrite,verbose = task
+
+    id3_definition = read_id3(input_path, preserved_tags, automatic_correction, verbose,)
+    write_id3(input_path, output_dir_path, id3_definition, auto_overwrite,)
+
 def main():
     arg_parser = argparse.ArgumentParser(
         "id3_retroencode",
@@ -328,6 +469,10 @@ def main():
         "-w", "--overwrite", action="store_true",
         help="Overwrite existing files on output without prompt",
     )
+    arg_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of files to process in parallel.\nValues above 1 imply -u and -w (workers cannot prompt)",
+    )
     arg_parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output during encoding",)
 
     arguments = arg_parser.parse_args()
@@ -340,9 +485,26 @@ def main():
     )
 
     if arguments.action.lower() == Action.RETRO.value:
-        for input_path in arguments.input:
-            id3_definition = read_id3(input_path, arguments.preserve, arguments.automatic, arguments.verbose,)
-            write_id3(input_path, arguments.output, id3_definition, arguments.overwrite,)
+        parallel = arguments.jobs > 1
+
+        tasks = [
+            (
+                input_path,
+                arguments.output,
+                tuple(arguments.preserve),
+                arguments.automatic or parallel,
+                arguments.overwrite or parallel,
+                arguments.verbose,
+            )
+            for input_path in arguments.input
+        ]
+
+        if parallel:
+            with ProcessPoolExecutor(max_workers=arguments.jobs) as executor:
+                list(executor.map(process_file, tasks))
+        else:
+            for task in tasks:
+                process_file(task)
 
 if __name__=="__main__":
     main()